@@ -13,6 +13,7 @@ from tmnt.estimator import BowEstimator
 from tmnt.distribution import LogisticGaussianDistribution, GaussianDistribution, VonMisesDistribution
 from tmnt.inference import BowVAEInferencer
 import optuna
+import torch
 from tmnt.utils.log_utils import logging_config
 import pyLDAvis
 import funcy
@@ -30,13 +31,23 @@ tf_vectorizer = TMNTVectorizer(vocab_size=2000, count_vectorizer_kwargs=dict(max
 X, _ = tf_vectorizer.fit_transform(data)
 
 
-def get_estimator(enc_size, lr, emb_size, alpha):
+# %%
+# Trials are run concurrently, one per available GPU (or a single trial at a time on CPU).
+# Each trial is placed on a device chosen by its trial number.
+n_gpus = torch.cuda.device_count()
+n_jobs = max(n_gpus, 1)
+
+def get_device(trial_number=0):
+    return 'cuda:{}'.format(trial_number % n_gpus) if n_gpus > 0 else 'cpu'
+
+def get_estimator(enc_size, lr, emb_size, alpha, device='cpu'):
     n_latent = 20
     epochs   = 64
-    distribution = LogisticGaussianDistribution(enc_size, n_latent, dr=0.2, alpha=alpha)
+    distribution = LogisticGaussianDistribution(enc_size, n_latent, dr=0.2, alpha=alpha, device=device)
     estimator = BowEstimator(vocabulary=tf_vectorizer.get_vocab(), latent_distribution=distribution,
                              log_method='log', lr=lr, batch_size=400, embedding_source='random', embedding_size=emb_size,
-                             epochs=epochs, enc_hidden_dim=enc_size, validate_each_epoch=False, quiet=False)
+                             epochs=epochs, enc_hidden_dim=enc_size, validate_each_epoch=False, quiet=False,
+                             device=device)
     return estimator
 
 def train_topic_model(trial):
@@ -45,12 +56,12 @@ def train_topic_model(trial):
     lr       = trial.suggest_float("lr", 1e-3, 1e-2)
     emb_size = trial.suggest_int("emb_size", 180, 220, 10)
     alpha    = trial.suggest_float("alpha", 0.5, 3.0)
-    estimator = get_estimator(enc_size, lr, emb_size, alpha)
+    estimator = get_estimator(enc_size, lr, emb_size, alpha, device=get_device(trial.number))
     objective, _ = estimator.fit_with_validation(X, None, X, None)
     return objective
 
 study = optuna.create_study(direction='maximize')
-study.optimize(train_topic_model, n_trials=24)
+study.optimize(train_topic_model, n_trials=24, n_jobs=n_jobs)
 
 best_lr = study.best_params['lr']
 best_emb_size = study.best_params['emb_size']
@@ -58,7 +69,7 @@ best_enc_size = study.best_params['enc_size']
 best_alpha    = study.best_params['alpha']
 
 # get estimator with best parameters and refit
-estimator = get_estimator(best_enc_size, best_lr, best_emb_size, best_alpha)
+estimator = get_estimator(best_enc_size, best_lr, best_emb_size, best_alpha, device=get_device())
 _,_ = estimator.fit_with_validation(X, None, X, None)
 
 
@@ -74,6 +74,15 @@ label_map = { l:i for i,l in enumerate(classes) }
 device = torch.device('cpu')
 epochs = 12
 
+# %%
+# Trials are run concurrently, one per available GPU (or a single trial at a time on CPU).
+# Each trial is placed on a device chosen by its trial number.
+n_gpus = torch.cuda.device_count()
+n_jobs = max(n_gpus, 1)
+
+def get_trial_device(trial_number):
+    return torch.device('cuda:{}'.format(trial_number % n_gpus)) if n_gpus > 0 else device
+
 # %%
 # Get the training and development data dataloaders
 train_loader = get_llm_dataloader(train_ds, vectorizer, tf_llm_name, label_map, batch_size, seq_len, device=device )
@@ -82,7 +91,7 @@ dev_loader = get_llm_dataloader(dev_ds, vectorizer, tf_llm_name, label_map, batc
 # %%
 # Function to provide the estimator object required for a single training run.
 # All searchable hyperparameters are provided as arguments to this function.
-def get_estimator(n_topics, alpha, lr, decoder_lr, entropy_loss_coef):
+def get_estimator(n_topics, alpha, lr, decoder_lr, entropy_loss_coef, device=device):
     latent_distribution = LogisticGaussianDistribution(768,n_topics,dr=0.05,alpha=alpha, device=device)
     estimator = SeqBowEstimator(llm_model_name = tf_llm_name,
                             latent_distribution = latent_distribution,
@@ -105,15 +114,18 @@ def train_topic_model(trial):
     decoder_lr = trial.suggest_float("decoder_lr", 0.001, 0.1)
     alpha    = trial.suggest_float("alpha", 0.5, 3.0)
     entropy_loss_coef = trial.suggest_float("entropy_loss_coef", 10.0, 10000.0, log=True)
-    estimator = get_estimator(n_topics, alpha, lr, decoder_lr, entropy_loss_coef)
-    objective, _ = estimator.fit_with_validation(train_loader, dev_loader, None)
+    estimator = get_estimator(n_topics, alpha, lr, decoder_lr, entropy_loss_coef, device=get_trial_device(trial.number))
+    ## loaders hold iteration state, so concurrent trials each get their own
+    trial_train_loader = get_llm_dataloader(train_ds, vectorizer, tf_llm_name, label_map, batch_size, seq_len, device=device)
+    trial_dev_loader = get_llm_dataloader(dev_ds, vectorizer, tf_llm_name, label_map, batch_size, seq_len, device=device)
+    objective, _ = estimator.fit_with_validation(trial_train_loader, trial_dev_loader, None)
     return objective
 
 # %%
 # Create the study and optimize over a given number of trials
 n_trials = 16
 study = optuna.create_study(direction='maximize')
-study.optimize(train_topic_model, n_trials=n_trials)
+study.optimize(train_topic_model, n_trials=n_trials, n_jobs=n_jobs)
 
 # %%
 # Now, get the best parameters returned from the search and refit the
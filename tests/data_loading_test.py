@@ -0,0 +1,129 @@
+import gc
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse as sp
+import torch
+from tmnt.data_loading import DeviceSparseDataLoader, SparseDataLoader, clear_device_data_cache
+import tmnt.data_loading as data_loading
+from tmnt.distribution import LogisticGaussianDistribution
+from tmnt.estimator import BowEstimator
+from tmnt.utils.vocab import build_vocab
+
+def _random_csr(n=53, m=40, seed=0):
+    return sp.random(n, m, density=0.1, format='csr', random_state=seed, dtype=np.float32)
+
+def test_device_cache_reused_for_same_matrix():
+    clear_device_data_cache()
+    X = _random_csr()
+    a = DeviceSparseDataLoader(X, None, batch_size=8)
+    b = DeviceSparseDataLoader(X, None, batch_size=16, shuffle=True)
+    assert a.values is b.values
+
+def test_device_cache_detects_in_place_changes():
+    clear_device_data_cache()
+    X = _random_csr()
+    a = DeviceSparseDataLoader(X, None, batch_size=8)
+    X.data[:] = 1.0
+    b = DeviceSparseDataLoader(X, None, batch_size=8)
+    assert a.values is not b.values
+    assert torch.all(b.values == 1.0)
+    batch, _ = next(iter(b))
+    assert torch.all(batch.coalesce().values() == 1.0)
+
+def test_device_cache_released_with_matrix():
+    clear_device_data_cache()
+    X = _random_csr()
+    loader = DeviceSparseDataLoader(X, None, batch_size=8)
+    assert len(data_loading._device_csr_cache) == 1
+    del loader, X
+    gc.collect()
+    assert len(data_loading._device_csr_cache) == 0
+
+def test_clear_device_data_cache():
+    X = _random_csr()
+    DeviceSparseDataLoader(X, None, batch_size=8)
+    clear_device_data_cache()
+    assert len(data_loading._device_csr_cache) == 0
+
+def _csr_with_empty_rows(n=53, m=40, seed=1):
+    X = _random_csr(n, m, seed).tolil()
+    for i in (0, 7, 8, n - 1):
+        X[i] = 0
+    return X.tocsr()
+
+def _collect_batches(loader):
+    ## labels are row ids, so each batch can be checked against the rows it claims to hold
+    return [ (data.to_dense().numpy(), labels.numpy()) for data, labels in loader ]
+
+def _check_batches(batches, X, batch_size, drop_last):
+    n = X.shape[0]
+    ## the last partial batch is only dropped when there is at least one full batch
+    drop_last = drop_last and n >= batch_size
+    n_batches = n // batch_size if drop_last else (n + batch_size - 1) // batch_size
+    assert len(batches) == n_batches
+    for data, rows in batches:
+        assert data.shape == (len(rows), X.shape[1])
+        assert np.array_equal(data, X[rows].toarray())
+    all_rows = np.concatenate([ rows for _, rows in batches ])
+    assert len(set(all_rows)) == len(all_rows)
+    if not drop_last:
+        assert sorted(all_rows) == list(range(n))
+
+def test_device_loader_matches_sparse_loader():
+    X = _csr_with_empty_rows()
+    y = np.arange(X.shape[0])
+    for batch_size in (1, 8, 16, 53, 64):
+        for drop_last in (False, True):
+            device_batches = _collect_batches(DeviceSparseDataLoader(X, y, batch_size=batch_size, drop_last=drop_last))
+            host_batches = _collect_batches(SparseDataLoader(X, y, batch_size=batch_size, drop_last=drop_last))
+            assert len(device_batches) == len(host_batches)
+            for (d1, r1), (d2, r2) in zip(device_batches, host_batches):
+                assert np.array_equal(r1, r2)
+                assert np.array_equal(d1, d2)
+            _check_batches(device_batches, X, batch_size, drop_last)
+
+def test_device_loader_shuffled_batches():
+    X = _csr_with_empty_rows()
+    y = np.arange(X.shape[0])
+    for batch_size in (1, 8, 16, 64):
+        for drop_last in (False, True):
+            loader = DeviceSparseDataLoader(X, y, batch_size=batch_size, shuffle=True, drop_last=drop_last)
+            _check_batches(_collect_batches(loader), X, batch_size, drop_last)
+            ## each pass draws a fresh permutation
+            _check_batches(_collect_batches(loader), X, batch_size, drop_last)
+            _check_batches(_collect_batches(SparseDataLoader(X, y, batch_size=batch_size, shuffle=True,
+                                                             drop_last=drop_last)), X, batch_size, drop_last)
+
+def test_drop_last_keeps_batch_smaller_than_batch_size():
+    X = _random_csr(n=120)
+    for loader_cls in (SparseDataLoader, DeviceSparseDataLoader):
+        assert len(list(loader_cls(X, None, batch_size=400, shuffle=True, drop_last=True))) == 1
+        assert len(loader_cls(X, None, batch_size=400, drop_last=True)) == 1
+        assert len(list(loader_cls(X, None, batch_size=50, shuffle=True, drop_last=True))) == 2
+        assert len(list(loader_cls(X, None, batch_size=50, shuffle=True))) == 3
+
+def test_device_cache_detects_sampled_partial_changes():
+    clear_device_data_cache()
+    X = _random_csr(n=400, m=200)
+    a = DeviceSparseDataLoader(X, None, batch_size=8)
+    X.data[::2] *= 2.0
+    b = DeviceSparseDataLoader(X, None, batch_size=8)
+    assert a.values is not b.values
+    assert np.allclose(b.values.numpy(), X.data)
+
+def test_estimator_reuses_device_data_across_fits(monkeypatch):
+    ## device residency is only chosen for CUDA devices; force it so the cache is exercised here
+    monkeypatch.setattr(BowEstimator, '_fits_on_device', lambda self, X: True)
+    clear_device_data_cache()
+    X = _random_csr(n=100, m=50)
+    val_X = _random_csr(n=40, m=50, seed=3)
+    vocab = build_vocab(OrderedDict((('w%d' % i), 1) for i in range(50)))
+    est = BowEstimator(vocabulary=vocab, latent_distribution=LogisticGaussianDistribution(20, 5),
+                       batch_size=32, epochs=1, enc_hidden_dim=20, embedding_size=16)
+    est.fit_with_validation(X, None, val_X, None)
+    assert len(data_loading._device_csr_cache) == 2
+    train_values = data_loading._get_device_csr(X, est.device)[2]
+    est.fit_with_validation(X, None, val_X, None)
+    assert len(data_loading._device_csr_cache) == 2
+    assert data_loading._get_device_csr(X, est.device)[2] is train_values
+    clear_device_data_cache()
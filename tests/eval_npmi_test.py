@@ -0,0 +1,44 @@
+# coding: utf-8
+
+from itertools import combinations
+from math import log10
+
+import numpy as np
+import scipy.sparse as sp
+
+from tmnt.eval_npmi import EvaluateNPMI
+
+
+def _brute_force_npmi(mat, top_k_words_per_topic):
+    dense = mat.toarray() > 0
+    n_docs = dense.shape[0]
+    total = 0.0
+    for words in top_k_words_per_topic:
+        topic_total = 0.0
+        for w1, w2 in combinations(sorted(words), 2):
+            c1, c2 = dense[:, w1].sum(), dense[:, w2].sum()
+            c12 = (dense[:, w1] & dense[:, w2]).sum()
+            if c12 >= 1:
+                topic_total += (log10(n_docs) + log10(c12) - log10(c1) - log10(c2)) / (log10(n_docs) - log10(c12) + 1e-4)
+        total += topic_total * 2 / (len(words) * (len(words) - 1))
+    return total / len(top_k_words_per_topic)
+
+
+def test_npmi_matches_brute_force_counts():
+    rng = np.random.default_rng(0)
+    mat = sp.random(200, 60, density=0.15, format='csr', random_state=1, data_rvs=lambda n: rng.integers(1, 4, n))
+    topics = [list(rng.choice(60, size=8, replace=False)) for _ in range(5)]
+    ## overlapping topics share terms
+    topics.append(topics[0][:4] + topics[1][:4])
+    npmi = EvaluateNPMI(topics).evaluate_csr_mat(mat)
+    assert np.isclose(npmi, _brute_force_npmi(mat, topics))
+
+
+def test_npmi_handles_non_canonical_input():
+    rows = np.array([0, 0, 1, 2, 2, 3])
+    cols = np.array([1, 1, 2, 1, 2, 3])
+    mat = sp.csr_matrix((np.ones(6), (rows, cols)), shape=(4, 5))
+    coo = sp.coo_matrix((np.ones(6), (rows, cols)), shape=(4, 5))
+    topics = [[1, 2, 3]]
+    assert np.isclose(EvaluateNPMI(topics).evaluate_csr_mat(coo), EvaluateNPMI(topics).evaluate_csr_mat(mat))
+    assert np.isclose(EvaluateNPMI(topics).evaluate_csr_mat(mat), _brute_force_npmi(mat, topics))
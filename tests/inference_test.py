@@ -0,0 +1,121 @@
+# coding: utf-8
+
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse as sp
+import pytest
+
+from tmnt.distribution import LogisticGaussianDistribution
+from tmnt.estimator import BowEstimator
+from tmnt.inference import BowVAEInferencer
+from tmnt.preprocess.vectorizer import TMNTVectorizer
+from tmnt.utils.vocab import build_vocab
+
+
+@pytest.fixture(scope='module')
+def fitted_estimator():
+    rng = np.random.RandomState(0)
+    X = sp.csr_matrix(rng.poisson(0.3, size=(120, 50)).astype('float32'))
+    vocab = build_vocab(OrderedDict((('w%d' % i), 1) for i in range(50)))
+    est = BowEstimator(vocabulary=vocab, latent_distribution=LogisticGaussianDistribution(20, 5),
+                       batch_size=32, epochs=1, enc_hidden_dim=20, embedding_size=16)
+    est.fit_with_validation(X, None, X, None) ## leaves the model in eval mode
+    return est, X
+
+
+def _inferencer(est, **kwargs):
+    return BowVAEInferencer(est, pre_vectorizer=TMNTVectorizer(initial_vocabulary=est.vocabulary), **kwargs)
+
+
+@pytest.mark.parametrize('max_batch_size', [1, 7, 32, 1000])
+def test_encode_data_preserves_row_order(fitted_estimator, max_batch_size):
+    est, X = fitted_estimator
+    inferencer = _inferencer(est, max_batch_size=max_batch_size)
+    encodings, _ = inferencer.encode_data(X, use_probs=False)
+    reversed_encodings, _ = inferencer.encode_data(X[::-1], use_probs=False)
+    assert encodings.shape == (X.shape[0], est.model.n_latent)
+    assert np.allclose(encodings, reversed_encodings[::-1], atol=1e-5)
+    single_rows = np.vstack([ inferencer.encode_data(X[i], use_probs=False)[0] for i in range(0, X.shape[0], 17) ])
+    assert np.allclose(encodings[::17], single_rows, atol=1e-5)
+
+
+@pytest.fixture(scope='module')
+def fitted_classifier():
+    rng = np.random.RandomState(0)
+    X = sp.csr_matrix(rng.poisson(0.3, size=(120, 50)).astype('float32'))
+    y = rng.randint(0, 3, size=120)
+    vocab = build_vocab(OrderedDict((('w%d' % i), 1) for i in range(50)))
+    est = BowEstimator(vocabulary=vocab, latent_distribution=LogisticGaussianDistribution(20, 5),
+                       batch_size=32, epochs=1, enc_hidden_dim=20, embedding_size=16, n_labels=3)
+    est.fit_with_validation(X, y, X, y)
+    return est, X
+
+
+def test_encode_data_predictions(fitted_classifier):
+    est, X = fitted_classifier
+    inferencer = _inferencer(est, max_batch_size=32)
+    encodings, predictions = inferencer.encode_data(X, include_predictions=True)
+    assert encodings.shape == (X.shape[0], est.model.n_latent)
+    assert predictions.shape == (X.shape[0], 3)
+    _, predictions = inferencer.encode_data(X)
+    assert predictions is None
+
+
+def test_encode_data_empty_input(fitted_classifier):
+    est, X = fitted_classifier
+    inferencer = _inferencer(est)
+    encodings, predictions = inferencer.encode_data(X[:0], include_predictions=True)
+    assert encodings.shape == (0, est.model.n_latent)
+    assert predictions.shape == (0, 3)
+
+
+def test_max_batch_size_bounds_batches(fitted_estimator):
+    est, X = fitted_estimator
+    inferencer = _inferencer(est, max_batch_size=25)
+    assert inferencer.max_batch_size == 25
+    assert not inferencer.auto_tune_batch_size
+    infer_iter, last_batch_size = inferencer._get_data_iterator(X, None)
+    assert len(infer_iter) == 5
+    assert last_batch_size == X.shape[0] % 25
+    assert inferencer._tuned_batch_size is None
+
+
+def test_auto_tune_batch_size(fitted_estimator):
+    est, X = fitted_estimator
+    inferencer = _inferencer(est, auto_tune_batch_size=True)
+    inferencer.encode_data(X)
+    assert inferencer._tuned_batch_size in (32, 64)
+    tuned = inferencer._tuned_batch_size
+    inferencer.encode_data(X[:10])
+    assert inferencer._tuned_batch_size == tuned
+
+
+def test_auto_tune_falls_back_on_small_input(fitted_estimator, monkeypatch):
+    est, X = fitted_estimator
+    inferencer = _inferencer(est, max_batch_size=16, auto_tune_batch_size=True)
+    n_tunings = []
+    auto_tune = inferencer._auto_tune_batch_size
+    monkeypatch.setattr(inferencer, '_auto_tune_batch_size', lambda data_mat: n_tunings.append(1) or auto_tune(data_mat))
+    inferencer.encode_data(X[:10])
+    assert inferencer._tuned_batch_size == 16
+    inferencer.encode_data(X)
+    assert len(n_tunings) == 1
+
+
+
+def test_auto_tune_respects_max_batch_size(fitted_estimator):
+    est, X = fitted_estimator
+    inferencer = _inferencer(est, max_batch_size=48, auto_tune_batch_size=True)
+    inferencer.encode_data(X)
+    assert inferencer._tuned_batch_size == 32
+
+
+def test_auto_tune_propagates_errors_other_than_out_of_memory(fitted_estimator, monkeypatch):
+    est, X = fitted_estimator
+    inferencer = _inferencer(est, auto_tune_batch_size=True)
+    def _fail(*args, **kwargs):
+        raise RuntimeError('not an allocation failure')
+    monkeypatch.setattr(inferencer.model, 'encode_data', _fail)
+    with pytest.raises(RuntimeError, match='not an allocation failure'):
+        inferencer._auto_tune_batch_size(X)
@@ -0,0 +1,87 @@
+# coding: utf-8
+
+import functools
+import io
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse as sp
+import torch
+from torch._dynamo.testing import CompileCounter
+
+from tmnt.data_loading import sparse_coo_to_tensor
+from tmnt.distribution import LogisticGaussianDistribution
+from tmnt.estimator import BowEstimator
+from tmnt.utils.vocab import build_vocab
+
+
+def _estimator(**kwargs):
+    vocab = build_vocab(OrderedDict((('w%d' % i), 1) for i in range(50)))
+    return BowEstimator(vocabulary=vocab, latent_distribution=LogisticGaussianDistribution(20, 5),
+                        batch_size=32, epochs=1, enc_hidden_dim=20, embedding_size=16, **kwargs)
+
+
+def _data(n=64):
+    rng = np.random.RandomState(0)
+    return sp.csr_matrix(rng.poisson(0.3, size=(n, 50)).astype('float32'))
+
+
+def test_compiled_dense_forward_runs_on_sparse_batches():
+    X = _data()
+    est = _estimator(n_labels=3)
+    est.setup_model_with_biases(X)
+    model = est.model
+    counter = CompileCounter()
+    model.compile_dense_forward(backend=counter, fullgraph=True)
+    data = sparse_coo_to_tensor(X.tocoo())
+    model.train()
+    torch.manual_seed(0)
+    compiled_loss, _, _, compiled_cls = model(data)
+    assert counter.frame_count == 1 and counter.op_count > 0
+    compiled_loss.mean().backward()
+    ## evaluation stays eager
+    model.eval()
+    model(data)
+    assert counter.frame_count == 1
+    model._compiled_dense_forward = None
+    model.train()
+    torch.manual_seed(0)
+    eager_loss, _, _, eager_cls = model(data)
+    assert torch.allclose(compiled_loss, eager_loss, atol=1e-5)
+    assert torch.allclose(compiled_cls, eager_cls, atol=1e-5)
+
+
+def test_compiled_model_can_be_saved():
+    X = _data()
+    est = _estimator()
+    est.setup_model_with_biases(X)
+    est.model.compile_dense_forward(backend=CompileCounter())
+    buf = io.BytesIO()
+    torch.save(est.model, buf)
+    buf.seek(0)
+    loaded = torch.load(buf, weights_only=False)
+    assert loaded._compiled_dense_forward is None
+    assert est.model._compiled_dense_forward is not None
+
+
+def test_estimator_trains_through_compiled_layers(monkeypatch):
+    counter = CompileCounter()
+    monkeypatch.setattr(torch, 'compile', functools.partial(torch.compile, backend=counter))
+    X = _data(100)
+    est = _estimator(compile_model=True)
+    est.fit_with_validation(X, None, X, None)
+    assert counter.frame_count >= 1
+
+
+def test_fit_with_batch_size_larger_than_data():
+    X = _data(20)
+    est = _estimator()
+    est.batch_size = 400
+    train_loader = est._get_sparse_loader(X, None, batch_size=est.batch_size, shuffle=True, drop_last=True)
+    assert len(list(train_loader)) == 1
+    est.warm_start = True
+    est.setup_model_with_biases(X)
+    initial_weight = est.model.embedding.linear.weight.detach().clone()
+    est.fit(X, None)
+    ## trained on the single (partial) batch rather than on no batches at all
+    assert not torch.equal(est.model.embedding.linear.weight, initial_weight)
@@ -0,0 +1,86 @@
+import io
+import json
+import pickle
+import numpy as np
+import pytest
+import tmnt.preprocess.vectorizer as vectorizer_module
+from tmnt.preprocess.vectorizer import TMNTVectorizer
+
+docs = ['the cat sat on the mat', 'dogs and cats are pets', 'the dog chased the cat'] * 10
+
+def test_pickle_round_trip():
+    vectorizer = TMNTVectorizer(vocab_size=20)
+    X, _ = vectorizer.fit_transform(docs)
+    loaded = pickle.loads(pickle.dumps(vectorizer))
+    X2, _ = loaded.transform(docs)
+    assert (X != X2).nnz == 0
+
+def test_unpickle_without_parallel_attributes():
+    vectorizer = TMNTVectorizer(vocab_size=20)
+    X, _ = vectorizer.fit_transform(docs)
+    ## simulate a vectorizer pickled before `n_jobs`/`docs_per_job` existed
+    del vectorizer.n_jobs
+    del vectorizer.docs_per_job
+    loaded = pickle.loads(pickle.dumps(vectorizer))
+    X2, _ = loaded.transform(docs)
+    assert loaded.n_jobs == 1
+    assert (X != X2).nnz == 0
+
+def test_parallel_transform_matches_serial():
+    vectorizer = TMNTVectorizer(vocab_size=20, n_jobs=2, docs_per_job=8)
+    X, _ = vectorizer.fit_transform(docs)
+    X2, _ = vectorizer.transform(docs)
+    assert (X != X2).nnz == 0
+    assert X2.shape == (len(docs), X.shape[1])
+
+def _write_json_list(path, records, encoding='utf-8'):
+    with io.open(path, 'w', encoding=encoding) as fp:
+        for r in records:
+            fp.write(json.dumps(r, ensure_ascii=False) + '\n')
+    return str(path)
+
+def _line_by_line(path, key, encoding='utf-8'):
+    with io.open(path, 'r', encoding=encoding) as fp:
+        return [ json.loads(l)[key] for l in fp ]
+
+records = [ {'body': d + ' café «quoted» \\n', 'label': 'a,b' if i % 2 else 'c', 'id': i}
+            for i, d in enumerate(docs) ]
+
+def test_arrow_json_reader_matches_line_reader(tmp_path, monkeypatch):
+    path = _write_json_list(tmp_path / 'docs.json', records)
+    vectorizer = TMNTVectorizer(vocab_size=20, label_key='label')
+    expected = _line_by_line(path, 'body')
+    with monkeypatch.context() as m:
+        ## the file must not be re-read line by line
+        m.setattr(vectorizer_module.io, 'open', None)
+        assert list(vectorizer._iter_json_str_column(path, 'body')) == expected
+        ## several small blocks
+        m.setattr(vectorizer_module, '_JSON_BLOCK_SIZE', 256)
+        assert list(vectorizer._iter_json_str_column(path, 'body')) == expected
+    monkeypatch.setattr(vectorizer_module, '_JSON_BLOCK_SIZE', 256)
+    assert vectorizer._get_y_strs(path) == [ l.split(',') for l in _line_by_line(path, 'label') ]
+    X, _ = vectorizer.fit_transform_json(path)
+    monkeypatch.setattr(vectorizer_module, 'pa_json', None)
+    X2, _ = TMNTVectorizer(vocab_size=20, label_key='label').fit_transform_json(path)
+    assert (X != X2).nnz == 0
+
+def test_json_reader_falls_back_for_other_encodings(tmp_path):
+    path = _write_json_list(tmp_path / 'docs.json', records, encoding='latin-1')
+    vectorizer = TMNTVectorizer(vocab_size=20, encoding='latin-1')
+    assert list(vectorizer._iter_json_str_column(path, 'body')) == _line_by_line(path, 'body', encoding='latin-1')
+
+def test_json_reader_falls_back_on_non_string_or_missing_values(tmp_path, monkeypatch):
+    monkeypatch.setattr(vectorizer_module, '_JSON_BLOCK_SIZE', 256)
+    vectorizer = TMNTVectorizer(vocab_size=20)
+    ## a non-string value after the first block: earlier values are not repeated
+    late_int = [ dict(r) for r in records ]
+    late_int[-3]['label'] = 3
+    path = _write_json_list(tmp_path / 'late_int.json', late_int)
+    assert list(vectorizer._iter_json_str_column(path, 'label')) == _line_by_line(path, 'label')
+    assert list(vectorizer._iter_json_str_column(path, 'id')) == list(range(len(records)))
+    ## a missing value is an error, as with line-by-line parsing
+    missing = [ dict(r) for r in records ]
+    del missing[-2]['body']
+    path = _write_json_list(tmp_path / 'missing.json', missing)
+    with pytest.raises(KeyError):
+        list(vectorizer._iter_json_str_column(path, 'body'))
@@ -19,6 +19,9 @@ from sklearn.datasets import load_svmlight_file
 from sklearn.utils import shuffle as sk_shuffle
 from tmnt.preprocess.vectorizer import TMNTVectorizer
 import random
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 from scipy import sparse as sp
 from typing import List, Tuple, Dict, Optional, Union, NoReturn
@@ -63,21 +66,15 @@ def get_unwrapped_llm_dataloader(data, bow_vectorizer, llm_name, label_map, batc
     text_pipeline  = get_llm_tokenizer(llm_name)
     
     def collate_batch(batch):
-        label_list, text_list, mask_list, bow_list = [], [], [], []
-        for (_label, _text, _target_text) in batch:
-            label_list.append(label_pipeline(_label))
-            tokenized_result = text_pipeline(_text, return_tensors='pt', padding='max_length',
-                                           max_length=max_len, truncation=True)
-            bag_of_words,_ = bow_vectorizer.transform([_target_text])
-            processed_text = tokenized_result['input_ids']
-            mask = tokenized_result['attention_mask']
-            mask_list.append(mask)
-            text_list.append(processed_text)
-            bow_list.append(bag_of_words)
-        label_list = torch.tensor(label_list, dtype=torch.int64)
-        text_list  = torch.vstack(text_list)
-        mask_list  = torch.vstack(mask_list)
-        bow_list   = torch.vstack([ sparse_coo_to_tensor(bow_vec.tocoo()) for bow_vec in bow_list ])
+        labels, texts, target_texts = zip(*batch)
+        label_list = torch.tensor([ label_pipeline(l) for l in labels ], dtype=torch.int64)
+        ## tokenize and vectorize the whole batch at once rather than document by document
+        tokenized_result = text_pipeline(list(texts), return_tensors='pt', padding='max_length',
+                                         max_length=max_len, truncation=True)
+        bow_matrix, _ = bow_vectorizer.transform(list(target_texts))
+        text_list  = tokenized_result['input_ids']
+        mask_list  = tokenized_result['attention_mask']
+        bow_list   = sparse_coo_to_tensor(bow_matrix.tocoo())
         return label_list.to(device), text_list.to(device), mask_list.to(device), bow_list.to(device)
     if bow_target_texts is not None:
         assert len(bow_target_texts) == len(data)
@@ -136,21 +133,14 @@ class StratifiedPairedLLMLoader():
         return batch_a, batch_b 
     
     def _collate_batch(self, batch, max_len):
-        label_list, text_list, mask_list, bow_list = [], [], [], []
-        for (_label, _text) in batch:
-            label_list.append(self.label_pipeline(_label))
-            tokenized_result = self.text_pipeline(_text, return_tensors='pt', padding='max_length',
-                                           max_length=max_len, truncation=True)
-            bag_of_words,_ = self.bow_vectorizer.transform([_text])
-            processed_text = tokenized_result['input_ids']
-            mask = tokenized_result['attention_mask']
-            mask_list.append(mask)
-            text_list.append(processed_text)
-            bow_list.append(bag_of_words)
-        label_list = torch.tensor(label_list, dtype=torch.int64)
-        text_list  = torch.vstack(text_list)
-        mask_list  = torch.vstack(mask_list)
-        bow_list   = torch.vstack([ sparse_coo_to_tensor(bow_vec.tocoo()) for bow_vec in bow_list ])
+        labels, texts = zip(*batch)
+        label_list = torch.tensor([ self.label_pipeline(l) for l in labels ], dtype=torch.int64)
+        tokenized_result = self.text_pipeline(list(texts), return_tensors='pt', padding='max_length',
+                                              max_length=max_len, truncation=True)
+        bow_matrix, _ = self.bow_vectorizer.transform(list(texts))
+        text_list  = tokenized_result['input_ids']
+        mask_list  = tokenized_result['attention_mask']
+        bow_list   = sparse_coo_to_tensor(bow_matrix.tocoo())
         return label_list.to(self.device), text_list.to(self.device), mask_list.to(self.device), bow_list.to(self.device)
 
 
@@ -212,15 +202,16 @@ def sparse_coo_to_tensor(coo: sp.coo_matrix):
     """
     Transform scipy coo matrix to pytorch sparse tensor
     """
-    values = coo.data
-    indices = (coo.row, coo.col)
-    shape = coo.shape
+    ## build the index/value arrays once in numpy and hand them to torch without
+    ## going through per-element Python conversion
+    indices = np.vstack((coo.row, coo.col)).astype(np.int64, copy=False)
+    values = coo.data.astype(np.float32, copy=False)
 
-    i = torch.LongTensor(indices)
-    v = torch.FloatTensor(values)
-    s = torch.Size(shape)
+    i = torch.from_numpy(indices)
+    v = torch.from_numpy(values)
+    s = torch.Size(coo.shape)
 
-    return torch.sparse.FloatTensor(i, v, s)
+    return torch.sparse_coo_tensor(i, v, s)
 
 
 def sparse_batch_collate(batch): 
@@ -252,15 +243,176 @@ class SparseDataLoader(DataLoader):
                  batch_size=1024, device='cpu'):
         self.batch_size = batch_size
         ds = SparseDataset(X, y)
-        sampler = torch.utils.data.sampler.BatchSampler(
-            torch.utils.data.sampler.RandomSampler(ds,
-                                                   generator=torch.Generator(device=device)),
-            batch_size=batch_size,
-            drop_last=False)
+        ## batches are formed by the batch sampler, so shuffling and dropping the last
+        ## partial batch must be handled there; unshuffled loaders preserve row order
+        if shuffle:
+            row_sampler = torch.utils.data.sampler.RandomSampler(ds, generator=torch.Generator(device=device))
+        else:
+            row_sampler = torch.utils.data.sampler.SequentialSampler(ds)
+        ## a matrix with fewer rows than batch_size still yields its one (partial) batch
+        drop_last = drop_last and X.shape[0] >= batch_size
+        sampler = torch.utils.data.sampler.BatchSampler(row_sampler, batch_size=batch_size, drop_last=drop_last)
         super().__init__(ds, batch_size=1, collate_fn=sparse_batch_collate, generator=torch.Generator(device=device),
-                         sampler=sampler, drop_last=drop_last)
+                         sampler=sampler)
         
 
+class PrefetchToDeviceLoader():
+    """
+    Wraps a loader yielding `(data, labels)` batches and moves each batch to `device` on a
+    background thread, one batch ahead of the consumer. Batch assembly then overlaps with
+    computation on the previous batch; for CUDA devices batches are first copied into pinned
+    (page-locked) host memory so that the host-to-device transfer is asynchronous as well.
+    """
+    def __init__(self, data_loader, device):
+        self.data_loader = data_loader
+        self.device = device
+        self._pin_memory = torch.device(device).type == 'cuda'
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        return self._prefetch_batches()
+
+    def _to_device(self, t):
+        ## non_blocking copies from pageable memory are synchronous
+        if self._pin_memory and t.device.type == 'cpu':
+            return t.pin_memory().to(self.device, non_blocking=True)
+        return t.to(self.device)
+
+    def _prefetch_batches(self):
+        data_iter = iter(self.data_loader)
+        def _next_on_device():
+            try:
+                data, labels = next(data_iter)
+            except StopIteration:
+                return None
+            data = self._to_device(data)
+            labels = self._to_device(labels) if labels is not None else None
+            return data, labels
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(_next_on_device)
+            while True:
+                batch = pending.result()
+                if batch is None:
+                    return
+                pending = executor.submit(_next_on_device)
+                yield batch
+
+
+## device-resident CSR components of recently loaded matrices, so repeated fits on the same data (e.g.
+## across model selection trials) skip the host-to-device copy. Entries are keyed on the identity of the
+## host matrix but hold only a weak reference to it: an entry is dropped as soon as its matrix is garbage
+## collected. Hashing the full matrix on every lookup would cost about as much as the copy it avoids, so
+## lookups instead compare a fingerprint of the shape, nnz and an evenly spaced sample of the matrix arrays.
+## This catches whole-array in-place changes (e.g. binarizing or reweighting `X.data`); callers that edit
+## only a few entries in place must call `clear_device_data_cache`. At most `_DEVICE_CSR_CACHE_SIZE`
+## entries are kept. Guarded by a lock since trials may run concurrently in threads (e.g. optuna with
+## n_jobs > 1).
+_DEVICE_CSR_CACHE_SIZE = 4
+_CSR_FINGERPRINT_SAMPLES = 1024
+_device_csr_cache = OrderedDict()
+_device_csr_cache_lock = threading.RLock() ## re-entrant: eviction may run from a GC finalizer
+
+def clear_device_data_cache():
+    """
+    Release the device copies of data matrices cached by :class:`DeviceSparseDataLoader`.
+    Call this after modifying a few entries of a matrix in place, which the cache may not detect.
+    """
+    with _device_csr_cache_lock:
+        _device_csr_cache.clear()
+
+def _evict_device_csr(x_id):
+    with _device_csr_cache_lock:
+        for key in [ k for k in _device_csr_cache if k[0] == x_id ]:
+            del _device_csr_cache[key]
+
+def _csr_fingerprint(csr):
+    samples = []
+    for a in (csr.indptr, csr.indices, csr.data):
+        step = max(1, len(a) // _CSR_FINGERPRINT_SAMPLES)
+        samples.append(a[::step].tobytes())
+    return (csr.shape, csr.nnz, tuple(samples))
+
+def _get_device_csr(X, device):
+    csr = X if sp.isspmatrix_csr(X) else sp.csr_matrix(X)
+    fingerprint = _csr_fingerprint(csr)
+    key = (id(X), str(device))
+    with _device_csr_cache_lock:
+        entry = _device_csr_cache.get(key)
+        if entry is not None and entry[0]() is X and entry[1] == fingerprint:
+            _device_csr_cache.move_to_end(key)
+            return entry[2]
+        tensors = (torch.from_numpy(csr.indptr.astype(np.int64)).to(device),
+                   torch.from_numpy(csr.indices.astype(np.int64)).to(device),
+                   torch.from_numpy(csr.data.astype(np.float32)).to(device))
+        if entry is None:
+            weakref.finalize(X, _evict_device_csr, id(X))
+        _device_csr_cache[key] = (weakref.ref(X), fingerprint, tensors)
+        _device_csr_cache.move_to_end(key)
+        if len(_device_csr_cache) > _DEVICE_CSR_CACHE_SIZE:
+            _device_csr_cache.popitem(last=False)
+        return tensors
+
+
+class DeviceSparseDataLoader():
+    """
+    Loader over a sparse matrix (and optional labels) whose CSR components are moved to `device`
+    once, up front. Each batch is gathered on the device into a sparse COO tensor, so no per-batch
+    host-to-device copies are made. Yields `(data, labels)` batches like :class:`SparseDataLoader`;
+    intended for data that fits comfortably in device memory.
+    """
+    def __init__(self,
+                 X: Union[sp.csr_matrix, sp.coo_matrix], y: np.array, shuffle=False, drop_last=False,
+                 batch_size=1024, device='cpu'):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+        self.dataset = SparseDataset(X, y)
+        self.shape = self.dataset.data.shape
+        ## as for SparseDataLoader, a matrix with fewer rows than batch_size still yields one batch
+        self.drop_last = drop_last and self.shape[0] >= batch_size
+        self.crow, self.col, self.values = _get_device_csr(self.dataset.data, device)
+        targets = self.dataset.targets
+        if targets is not None:
+            targets = targets.toarray() if sp.issparse(targets) else np.asarray(targets)
+            self.labels = torch.as_tensor(targets, dtype=torch.int64).to(device)
+        else:
+            self.labels = None
+        self._order = None
+        self._batch_index = 0
+
+    def __len__(self):
+        n = self.shape[0]
+        return n // self.batch_size if self.drop_last else (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = self.shape[0]
+        self._order = torch.randperm(n, device=self.device) if self.shuffle else torch.arange(n, device=self.device)
+        self._batch_index = 0
+        return self
+
+    def __next__(self):
+        if self._order is None:
+            self.__iter__()
+        if self._batch_index >= len(self):
+            raise StopIteration
+        rows = self._order[self._batch_index * self.batch_size:(self._batch_index + 1) * self.batch_size]
+        self._batch_index += 1
+        labels = self.labels[rows] if self.labels is not None else None
+        return self._gather_rows(rows), labels
+
+    def _gather_rows(self, rows):
+        starts = self.crow[rows]
+        lengths = self.crow[rows + 1] - starts
+        batch_rows = torch.repeat_interleave(torch.arange(rows.shape[0], device=self.device), lengths)
+        ## position of each non-zero within its row, added to the row's start offset in `col`/`values`
+        row_offsets = torch.repeat_interleave(torch.cumsum(lengths, 0) - lengths, lengths)
+        positions = torch.repeat_interleave(starts, lengths) + \
+            torch.arange(batch_rows.shape[0], device=self.device) - row_offsets
+        indices = torch.stack((batch_rows, self.col[positions]))
+        return torch.sparse_coo_tensor(indices, self.values[positions], torch.Size((rows.shape[0], self.shape[1])))
+
 
 class SingletonWrapperLoader():
 
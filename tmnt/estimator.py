@@ -16,7 +16,7 @@ import scipy.sparse as sp
 import json
 
 from sklearn.metrics import average_precision_score, top_k_accuracy_score, roc_auc_score, ndcg_score, precision_recall_fscore_support
-from tmnt.data_loading import PairedDataLoader, SingletonWrapperLoader, SparseDataLoader, get_llm_model
+from tmnt.data_loading import PairedDataLoader, SingletonWrapperLoader, SparseDataLoader, DeviceSparseDataLoader, get_llm_model
 from tmnt.modeling import BowVAEModel, SeqBowVED, BaseVAE
 from tmnt.modeling import CrossBatchCosineSimilarityLoss, GeneralizedSDMLLoss, MultiNegativeCrossEntropyLoss, MetricSeqBowVED, MetricBowVAEModel
 from tmnt.eval_npmi import EvaluateNPMI
@@ -43,6 +43,7 @@ from torch.utils.data import Dataset, DataLoader
 from tqdm import tqdm
 
 MAX_DESIGN_MATRIX = 250000000
+MAX_DEVICE_RESIDENT_FRACTION = 0.25 ## sparse inputs needing at most this fraction of free GPU memory are kept on the GPU
 
 
 class BaseEstimator(object):
@@ -137,7 +138,7 @@ class BaseEstimator(object):
         Returns:
             npmi (float): NPMI score.
         """
-        sorted_ids = self.model.get_ordered_terms()
+        sorted_ids = self.model.get_top_k_terms(k)
         num_topics = min(self.n_latent, sorted_ids.shape[-1])
         top_k_words_per_topic = [[int(i) for i in list(sorted_ids[:k, t])] for t in range(self.n_latent)]
         npmi_eval = EvaluateNPMI(top_k_words_per_topic)
@@ -204,6 +205,7 @@ class BaseBowEstimator(BaseEstimator):
         validate_each_epoch: Perform validation of model against heldout validation 
             data after each training epoch
         multilabel: Assume labels are vectors denoting label sets associated with each document
+        compile_model: Compile the dense layers of the model with `torch.compile` for training (see `BowVAEModel.compile_dense_forward`)
     """
     def __init__(self,
                  n_labels: int = 0,
@@ -217,6 +219,7 @@ class BaseBowEstimator(BaseEstimator):
                  num_enc_layers: int = 1,
                  enc_dr: float = 0.1,
                  classifier_dropout: float = 0.1,
+                 compile_model: bool = False,
                  *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.enc_hidden_dim = enc_hidden_dim
@@ -231,6 +234,7 @@ class BaseBowEstimator(BaseEstimator):
         self.gamma = gamma
         self.n_labels = n_labels
         self.has_classifier = n_labels > 1
+        self.compile_model = compile_model
         self.loss_function = torch.nn.BCEWithLogitsLoss() if multilabel else torch.nn.CrossEntropyLoss()
 
     @classmethod
@@ -383,7 +387,7 @@ class BaseBowEstimator(BaseEstimator):
         raise NotImplementedError()
 
     def _npmi_with_dataloader(self, dataloader, k=10):
-        sorted_ids = self.model.get_ordered_terms_encoder(dataloader) if self.coherence_via_encoder else self.model.get_ordered_terms()
+        sorted_ids = self.model.get_ordered_terms_encoder(dataloader) if self.coherence_via_encoder else self.model.get_top_k_terms(k)
         num_topics = min(self.n_latent, sorted_ids.shape[-1])
         top_k_words_per_topic = [[int(i) for i in list(sorted_ids[:k, t])] for t in range(self.n_latent)]
         npmi_eval = EvaluateNPMI(top_k_words_per_topic)
@@ -398,14 +402,17 @@ class BaseBowEstimator(BaseEstimator):
         return npmi, redundancy
     
     def _perplexity(self, dataloader, total_words):
-        total_rec_loss = 0
-        total_kl_loss  = 0
+        ## accumulate on the device and synchronize once after the pass over the data
+        rec_loss_sum = torch.zeros((), device=self.device)
+        kl_loss_sum  = torch.zeros((), device=self.device)
         with torch.no_grad():
             for i, ((data,labels),) in enumerate(dataloader):
                 data = data.to(self.device)
                 _, kl_loss, rec_loss, _ = self._forward(self.model, data)
-                total_rec_loss += float(rec_loss.sum())
-                total_kl_loss += float(kl_loss.sum())
+                rec_loss_sum += rec_loss.sum()
+                kl_loss_sum += kl_loss.sum()
+        total_rec_loss = float(rec_loss_sum)
+        total_kl_loss  = float(kl_loss_sum)
         if ((total_rec_loss + total_kl_loss) / total_words) < 709.0:
             perplexity = math.exp((total_rec_loss + total_kl_loss) / total_words)
         else:
@@ -466,7 +473,7 @@ class BaseBowEstimator(BaseEstimator):
         return v_res
 
     def validate(self, val_X, val_y):
-        val_dataloader = SingletonWrapperLoader(SparseDataLoader(val_X, val_y, batch_size=self.test_batch_size))
+        val_dataloader = SingletonWrapperLoader(self._get_sparse_loader(val_X, val_y, batch_size=self.test_batch_size))
         total_val_words = val_X.sum()
         if self.num_val_words < 0:
             self.num_val_words = total_val_words
@@ -503,7 +510,7 @@ class BaseBowEstimator(BaseEstimator):
         labels = labels.to(self.device)
         
         elbo_ls, kl_ls, rec_ls, predicted_labels = \
-            self._forward(self.model, data)
+            self._forward(model, data)
         if self.has_classifier:
             labels = labels.float() if self.multilabel else labels
             label_ls = self.loss_function(predicted_labels, labels).mean()
@@ -529,10 +536,14 @@ class BaseBowEstimator(BaseEstimator):
         sc_obj, npmi, ppl, redundancy = 0.0, 0.0, 0.0, 0.0
         v_res = None
         joint_loader = PairedDataLoader(train_dataloader, aux_dataloader)
+        if self.compile_model:
+            self.model.compile_dense_forward(dynamic=False)
         for epoch in range(self.epochs):
             ts_epoch = time.time()
-            elbo_losses = []
-            lab_losses  = []
+            ## running loss sums are kept on the device to avoid a host sync per batch
+            elbo_loss_sum = torch.zeros((), device=self.device)
+            lab_loss_sum  = torch.zeros((), device=self.device)
+            n_batches = 0
             self.model.train()
             for i, (data_batch, aux_batch) in enumerate(joint_loader):
                 elbo_ls, kl_loss, _, lab_loss, total_ls = self._get_losses(self.model, data_batch)
@@ -549,15 +560,15 @@ class BaseBowEstimator(BaseEstimator):
                 trainer.step()
                 trainer.zero_grad()
                 if not self.quiet:
+                    elbo_loss_sum += elbo_mean.detach()
                     if aux_batch is not None:
-                        elbo_losses.append(float(elbo_mean) + float(elbo_ls_a.mean()))
-                    else:
-                        elbo_losses.append(float(elbo_mean))                        
+                        elbo_loss_sum += elbo_ls_a.mean().detach()
                     if lab_loss is not None:
-                        lab_losses.append(float(lab_loss.mean()))
+                        lab_loss_sum += lab_loss.mean().detach()
+                    n_batches += 1
             if not self.quiet and not self.validate_each_epoch:
-                elbo_mean = np.mean(elbo_losses) if len(elbo_losses) > 0 else 0.0
-                lab_mean  = np.mean(lab_losses) if len(lab_losses) > 0 else 0.0
+                elbo_mean = float(elbo_loss_sum) / n_batches if n_batches > 0 else 0.0
+                lab_mean  = float(lab_loss_sum) / n_batches if n_batches > 0 else 0.0
                 self._output_status("Epoch [{}] finished in {} seconds. [elbo = {}, label loss = {}]"
                                     .format(epoch+1, (time.time()-ts_epoch), elbo_mean, lab_mean))
             if validation_dataloader is not None and (self.validate_each_epoch or epoch == self.epochs-1):
@@ -593,6 +604,7 @@ class BaseBowEstimator(BaseEstimator):
         wd_freqs = self._get_wd_freqs(X)
         x_size = X.shape[0] * X.shape[1]
         if self.model is None or not self.warm_start:
+            ## always a new model: one from a previous fit may already be held elsewhere (e.g. by an inferencer)
             self.model = self._get_model()
             self.model.initialize_bias_terms(wd_freqs.squeeze())  ## initialize bias weights to log frequencies
         if self.npmi_matrix is not None:
@@ -601,6 +613,22 @@ class BaseBowEstimator(BaseEstimator):
 
     
 
+    def _fits_on_device(self, X):
+        device = torch.device(self.device)
+        if device.type != 'cuda':
+            return False
+        ## int64 row pointers and column indices plus float32 values
+        n_bytes = (X.shape[0] + 1) * 8 + X.nnz * (8 + 4)
+        free_bytes, _ = torch.cuda.mem_get_info(device)
+        return n_bytes <= MAX_DEVICE_RESIDENT_FRACTION * free_bytes
+
+    def _get_sparse_loader(self, X, y, batch_size, shuffle=False, drop_last=False):
+        ## sparse matrices that fit comfortably in GPU memory are moved there once, avoiding per-batch copies
+        if sp.issparse(X) and self._fits_on_device(X):
+            return DeviceSparseDataLoader(X, y, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last,
+                                          device=self.device)
+        return SparseDataLoader(X, y, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last)
+
     def fit_with_validation(self, 
                             X: Union[torch.Tensor, sp.coo_matrix, sp.csr_matrix],
                             y: Union[torch.Tensor, np.ndarray],
@@ -622,24 +650,27 @@ class BaseBowEstimator(BaseEstimator):
             sc_obj, v_res
         """
 
-        train_dataloader = SparseDataLoader(X, y, batch_size=self.batch_size, drop_last=True)
+        train_dataloader = self._get_sparse_loader(X, y, batch_size=self.batch_size, shuffle=True, drop_last=True)
         X_data = train_dataloader.dataset.data
         train_dataloader = SingletonWrapperLoader(train_dataloader)
         train_X_size = X_data.shape
         _ = self.setup_model_with_biases(X_data)
 
         if aux_X is not None:
-            aux_dataloader = SparseDataLoader(X, y, batch_size=self.batch_size)
+            aux_dataloader = SparseDataLoader(X, y, batch_size=self.batch_size, shuffle=True)
             aux_shape = aux_dataloader.dataset.data.shape
             aux_X_size = aux_shape[0] * aux_shape[1]
             aux_dataloader   = SingletonWrapperLoader(aux_dataloader)        
         else:
             aux_dataloader, aux_X_size = None, 0
         if val_X is not None:
-            val_dataloader = SparseDataLoader(val_X, val_y, batch_size=self.test_batch_size)
+            val_dataloader = self._get_sparse_loader(val_X, val_y, batch_size=self.test_batch_size)
             total_val_words = val_X.sum()
             val_X_size = val_X.shape[0] * val_X.shape[1]
             val_dataloader = SingletonWrapperLoader(val_dataloader)
+            if val_y is not None and self.has_classifier and len(val_y.shape) == 1:
+                ## one-hot once here, rather than at every validation pass
+                val_y = self._np_one_hot(np.asarray(val_y), self.n_labels)
         else:
             val_dataloader, total_val_words, val_X_size = None, 0, 0
 
@@ -840,18 +871,16 @@ class BowMetricEstimator(BowEstimator):
             dists = self.loss_function._compute_distances(z_mu1, z_mu2)
             probs = torch.nn.functional.softmax(-dists, axis=1).detach().numpy()
             posteriors += list(probs)
-            label1 = np.array(label1.squeeze().detach().numpy(), dtype='int')
+            label1 = np.array(label1.detach().cpu().numpy(), dtype='int').reshape(-1)
             ground_truth_idx += list(label1) ## index values for labels
-            gt = np.zeros((label1.size()[0], int(max(label2).asscalar())+1))
-            gt[np.arange(label1.size()[0]), label1] = 1
-            ground_truth += list(gt)
+            ground_truth += list(self._np_one_hot(label1, int(label2.max()) + 1))
             if emb2 is None:
                 emb2 = z_mu2.detach().numpy()
             emb1 += list(z_mu1.detach().numpy())
         posteriors = np.array(posteriors)
         ground_truth = np.array(ground_truth)
         ground_truth_idx = np.array(ground_truth_idx)
-        labels = np.arange(posteriors[0].size()[0])        
+        labels = np.arange(posteriors.shape[1])
         try:
             auroc = roc_auc_score(ground_truth, posteriors, average='weighted', labels=labels)
         except:
@@ -1129,8 +1158,7 @@ class SeqBowEstimator(BaseEstimator):
         sums = torch.zeros(len(self.vocabulary)).to(self.device)
         for i, data in enumerate(dataloader):
             seqs, = data
-            bow_batch = seqs[3].to_dense()
-            sums += bow_batch.sum(axis=0)
+            sums += torch.sparse.sum(seqs[3], dim=0).to_dense().to(self.device)
         return sums.cpu().numpy()
 
     def _get_objective_from_validation_result(self, val_result):
@@ -1304,7 +1332,7 @@ class SeqBowEstimator(BaseEstimator):
 
     def _compute_coherence(self, model, k, test_data, log_terms=False):
         num_topics = model.n_latent
-        sorted_ids = model.get_ordered_terms()
+        sorted_ids = model.get_top_k_terms(k)
         num_topics = min(num_topics, sorted_ids.shape[-1])
         top_k_words_per_topic = [[ int(i) for i in list(sorted_ids[:k, t])] for t in range(num_topics)]
         npmi_eval = EvaluateNPMI(top_k_words_per_topic)
@@ -1339,22 +1367,25 @@ class SeqBowEstimator(BaseEstimator):
         npmi, redundancy = self._compute_coherence(model, 10, bow_matrix, log_terms=True)
         if self.metric is not None:
             self.metric.reset()
-        step_loss = 0
-        elbo_loss  = 0
-        total_rec_loss = 0.0
-        total_kl_loss  = 0.0
+        ## loss sums stay on the device; they are only synchronized when logged
+        step_loss = torch.zeros((), device=self.device)
+        elbo_loss  = torch.zeros((), device=self.device)
+        rec_loss_sum = torch.zeros((), device=self.device)
+        kl_loss_sum  = torch.zeros((), device=self.device)
         model.eval()
         for batch_id, seqs in enumerate(dataloader):
             elbo_ls, rec_ls, kl_ls, red_ls, label_ls, total_ls = self._get_losses(model, seqs)
-            total_rec_loss += float(rec_ls.sum().cpu().detach())
-            total_kl_loss  += float(kl_ls.sum().cpu().detach())
-            step_loss += float(total_ls.mean().cpu().detach())
-            elbo_loss  += float(elbo_ls.mean().cpu().detach())
+            rec_loss_sum += rec_ls.sum().detach()
+            kl_loss_sum  += kl_ls.sum().detach()
+            step_loss += total_ls.mean().detach()
+            elbo_loss  += elbo_ls.mean().detach()
             if (batch_id + 1) % (self.log_interval) == 0:
                 logging.debug('All loss terms: {}, {}, {}, {}, {}, {}'.format(elbo_ls, rec_ls, kl_ls, red_ls, label_ls, total_ls))
-                self.log_eval(batch_id, len(dataloader), step_loss, elbo_loss, self.log_interval)
-                step_loss = 0
-                elbo_loss = 0
+                self.log_eval(batch_id, len(dataloader), float(step_loss), float(elbo_loss), self.log_interval)
+                step_loss.zero_()
+                elbo_loss.zero_()
+        total_rec_loss = float(rec_loss_sum)
+        total_kl_loss  = float(kl_loss_sum)
         likelihood = (total_rec_loss + total_kl_loss) / float(num_words)
         if likelihood < 709.0:
             perplexity = math.exp(likelihood)
@@ -1404,12 +1435,8 @@ class SeqBowMetricEstimator(SeqBowEstimator):
     def _get_bow_wd_counts(self, dataloader):
         sums = torch.zeros(len(self.vocabulary)).to(self.device)
         for i, (data_a, data_b) in enumerate(dataloader):
-            seqs_a = data_a
-            bow_batch_a = seqs_a[3].to_dense()
-            seqs_b = data_b
-            bow_batch_b = seqs_b[3].to_dense()
-            sums += bow_batch_a.sum(axis=0)
-            sums += bow_batch_b.sum(axis=0)
+            sums += torch.sparse.sum(data_a[3], dim=0).to_dense().to(self.device)
+            sums += torch.sparse.sum(data_b[3], dim=0).to_dense().to(self.device)
         return sums.cpu().numpy()        
         
     def _get_bow_matrix(self, dataloader, cache=False):
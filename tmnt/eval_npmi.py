@@ -57,32 +57,30 @@ class EvaluateNPMI(object):
         return total_npmi / len(self.top_k_words_per_topic)
 
     def evaluate_csr_mat(self, csr_mat):
-        if isinstance(csr_mat, scipy.sparse.csr.csr_matrix):
-            is_sparse = True
-            mat = csr_mat
+        if scipy.sparse.issparse(csr_mat):
+            mat = csr_mat.tocsr()
         else:
-            #is_sparse = isinstance(csr_mat, mx.nd.sparse.CSRNDArray)
-            is_sparse = False
-            if is_sparse:
-                mat = csr_mat.asscipy()
-            else:
-                mat = csr_mat.to_dense().cpu().numpy()
+            mat = scipy.sparse.csr_matrix(csr_mat.to_dense().cpu().numpy())
+        if not mat.has_canonical_format:
+            mat = mat.copy()
+            mat.sum_duplicates()
         n_docs = mat.shape[0]
+        ## binary document-occurrence matrix restricted to the topic terms, column-major for per-topic slicing
+        topic_terms = sorted(set(w for words_per_topic in self.top_k_words_per_topic for w in words_per_topic))
+        term_slots = { w: i for i, w in enumerate(topic_terms) }
+        occurs = (mat[:, topic_terms] > 0).astype(np.int64).tocsc()
         total_npmi = 0
         for i, words_per_topic in enumerate(self.top_k_words_per_topic):
             total_topic_npmi = 0
             n_topics = len(words_per_topic)
-            for (w1, w2) in combinations(sorted(words_per_topic), 2):
-                o_1 = mat[:, w1] > 0
-                o_2 = mat[:, w2] > 0
-                if is_sparse:
-                    o_1 = o_1.toarray().squeeze()
-                    o_2 = o_2.toarray().squeeze()
-                occur_1 = np.array(o_1, dtype='int')
-                occur_2 = np.array(o_2, dtype='int')
-                unigram_1 = occur_1.sum()
-                unigram_2 = occur_2.sum()
-                bigram_cnt = np.sum(occur_1 * occur_2)
+            words = sorted(words_per_topic)
+            topic_occurs = occurs[:, [ term_slots[w] for w in words ]]
+            ## (k x k) document co-occurrence counts for this topic's terms; the diagonal holds document frequencies
+            cooccur = (topic_occurs.T @ topic_occurs).toarray()
+            for (s1, s2) in combinations(range(len(words)), 2):
+                unigram_1 = cooccur[s1, s1]
+                unigram_2 = cooccur[s2, s2]
+                bigram_cnt = cooccur[s1, s2]
                 if bigram_cnt < 1:
                     npmi = 0.0
                 else:
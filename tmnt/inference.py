@@ -8,11 +8,12 @@ import json
 import numpy as np
 import io
 import os
+import time
 import torch
 import pickle
 from tmnt.modeling import BowVAEModel, SeqBowVED, MetricSeqBowVED
 from tmnt.estimator import BowEstimator, SeqBowEstimator, SeqBowMetricEstimator
-from tmnt.data_loading import SparseDataLoader
+from tmnt.data_loading import SparseDataLoader, PrefetchToDeviceLoader, sparse_batch_collate
 from tmnt.preprocess.vectorizer import TMNTVectorizer
 from tmnt.utils.recalibrate import recalibrate_scores
 from sklearn.datasets import load_svmlight_file
@@ -25,6 +26,21 @@ from tmnt.distribution import ConceptLogisticGaussianDistribution
 
 MAX_DESIGN_MATRIX = 250000000 
 
+
+def _dump_ndarray_as_json(fp, arr):
+    """Write `arr` to `fp` as a JSON list, emitting one row at a time for 2-d arrays."""
+    arr = np.asarray(arr)
+    if arr.ndim < 2:
+        json.dump(arr.tolist(), fp)
+    else:
+        fp.write('[')
+        for i, row in enumerate(arr):
+            if i > 0:
+                fp.write(',\n')
+            json.dump(row.tolist(), fp)
+        fp.write(']')
+
+
 class BaseInferencer(object):
     """Base inference object for text encoding with a trained topic model.
 
@@ -55,33 +71,44 @@ class BaseInferencer(object):
     def get_top_k_words_per_topic(self, k):
         raise NotImplementedError
 
-    def get_pyldavis_details(self, sp_vec_file_or_X, y=None):
+    def _get_pyldavis_arrays(self, sp_vec_file_or_X, y=None):
         w_pr, dt_matrix, doc_lengths, term_cnts = self.get_model_details(sp_vec_file_or_X, y=y)
-        d1 = w_pr.cpu().detach().numpy().tolist()
-        d2 = list(map(lambda x: x.tolist(), dt_matrix))
-        doc_lengths = np.array(doc_lengths)
-        d3 = list(doc_lengths.squeeze())
-        d5 = term_cnts.squeeze().tolist()
-        d4 = list(map(lambda i: self.vocab.lookup_token(i), range(len(self.vocab))))
-        d = {'topic_term_dists': d1, 'doc_topic_dists': d2, 'doc_lengths': d3, 'vocab': d4, 'term_frequency': d5 }
-        return d
+        return {'topic_term_dists': w_pr.cpu().detach().numpy(),
+                'doc_topic_dists': np.asarray(dt_matrix),
+                'doc_lengths': np.asarray(doc_lengths).ravel(),
+                'vocab': list(map(lambda i: self.vocab.lookup_token(i), range(len(self.vocab)))),
+                'term_frequency': np.asarray(term_cnts).ravel()}
+
+    def get_pyldavis_details(self, sp_vec_file_or_X, y=None):
+        d = self._get_pyldavis_arrays(sp_vec_file_or_X, y=y)
+        return {k: (v.tolist() if isinstance(v, np.ndarray) else v) for k, v in d.items()}
 
 
 class BowVAEInferencer(BaseInferencer):
     """
+    Inferencer for bag-of-words topic models.
+
+    Parameters:
+        estimator: Fitted estimator
+        pre_vectorizer: Vectorizer used to map raw text to document-term matrices
+        max_batch_size: Maximum number of documents encoded per batch (default = 256)
+        auto_tune_batch_size: Time encoding on the first data matrix seen at several batch sizes
+            and use the fastest for this and all subsequent calls (default = False)
     """
-    def __init__(self, estimator, pre_vectorizer=None):
+    def __init__(self, estimator, pre_vectorizer=None, max_batch_size: int = 256, auto_tune_batch_size: bool = False):
         super().__init__(estimator,
                          pre_vectorizer or TMNTVectorizer(initial_vocabulary=estimator.model.vocabulary),
                          estimator.model.device)
-        self.max_batch_size = 16
+        self.max_batch_size = max_batch_size
+        self.auto_tune_batch_size = auto_tune_batch_size
+        self._tuned_batch_size = None
         self.vocab = estimator.vocabulary
         self.n_latent = estimator.n_latent
         self.model = estimator.model
         self.covar_model = False
 
     @classmethod
-    def from_saved(cls, model_dir=None, device='cpu'):
+    def from_saved(cls, model_dir=None, device='cpu', max_batch_size=256, auto_tune_batch_size=False):
         serialized_vectorizer_file = None
         config_file = os.path.join(model_dir,'model.config')
         param_file = os.path.join(model_dir,'model.params')
@@ -96,7 +123,8 @@ class BowVAEInferencer(BaseInferencer):
                 vectorizer = pickle.load(fp)
         else:
             vectorizer = None
-        return cls(estimator, pre_vectorizer=vectorizer)
+        return cls(estimator, pre_vectorizer=vectorizer, max_batch_size=max_batch_size,
+                   auto_tune_batch_size=auto_tune_batch_size)
 
 
     def get_model_details(self, sp_vec_file_or_X, y=None):
@@ -131,9 +159,16 @@ class BowVAEInferencer(BaseInferencer):
             plt.savefig(f)
 
     def export_full_model_inference_details(self, sp_vec_file, ofile):
-        d = self.get_pyldavis_details(sp_vec_file)
+        d = self._get_pyldavis_arrays(sp_vec_file)
+        ## stream each field (in sorted key order) rather than materializing nested Python lists
         with io.open(ofile, 'w') as fp:
-            json.dump(d, fp, sort_keys=True, indent=4)        
+            fp.write('{')
+            for i, k in enumerate(sorted(d)):
+                if i > 0:
+                    fp.write(',\n')
+                fp.write(json.dumps(k) + ': ')
+                _dump_ndarray_as_json(fp, d[k])
+            fp.write('}\n')
 
     def encode_vec_file(self, sp_vec_file, use_probs=False):
         data_mat, labels = load_svmlight_file(sp_vec_file, n_features=len(self.vocab), zero_based=True)
@@ -145,9 +180,40 @@ class BowVAEInferencer(BaseInferencer):
                                      target_entropy=target_entropy)
         return encodings
 
+    def _auto_tune_batch_size(self, data_mat, candidate_sizes=(32, 64, 128, 256, 512)):
+        """Time the encoder on leading rows of `data_mat` at each candidate batch size up to
+        `max_batch_size` and return the size with the highest throughput. Falls back to `max_batch_size` if `data_mat` is too
+        small to measure any candidate, so that tuning is not retried on every call.
+        """
+        best_size, best_rate = None, 0.0
+        on_gpu = torch.device(self.device).type == 'cuda'
+        for size in sorted(size for size in candidate_sizes if size <= self.max_batch_size):
+            if data_mat.shape[0] < size:
+                break
+            data, _ = sparse_batch_collate([(data_mat[:size], None)])
+            data = data.to(self.device)
+            try:
+                with torch.no_grad():
+                    self.model.encode_data(data) # warm-up
+                    if on_gpu:
+                        torch.cuda.synchronize()
+                    start = time.time()
+                    self.model.encode_data(data)
+                    if on_gpu:
+                        torch.cuda.synchronize()
+                    elapsed = time.time() - start
+            except torch.cuda.OutOfMemoryError:
+                break
+            rate = size / max(elapsed, 1e-9)
+            if rate > best_rate:
+                best_size, best_rate = size, rate
+        return best_size or self.max_batch_size
+
     def _get_data_iterator(self, data_mat, labels):
         x_size = data_mat.shape[0] * data_mat.shape[1]
-        batch_size = min(data_mat.shape[0], self.max_batch_size)
+        if self.auto_tune_batch_size and self._tuned_batch_size is None:
+            self._tuned_batch_size = self._auto_tune_batch_size(data_mat)
+        batch_size = max(1, min(data_mat.shape[0], self._tuned_batch_size or self.max_batch_size))
         last_batch_size = data_mat.shape[0] % batch_size
         covars = None
         #torch.one_hot(torch.Tensor(labels, dtype='int'), num_classes=self.n_covars) \
@@ -157,27 +223,39 @@ class BowVAEInferencer(BaseInferencer):
 
     def encode_data(self, data_mat, labels=None, use_probs=True, include_bn=True, target_entropy=1.0, include_predictions=False):
         infer_iter, last_batch_size = self._get_data_iterator(data_mat, labels)
-        encodings = []
-        predictions = []
-        for _, (data,labels) in enumerate(infer_iter):
+        n_docs = data_mat.shape[0]
+        ## outputs are preallocated once the width is known and filled by offset
+        ## predictions are None unless requested
+        encodings = None
+        predictions = None
+        pos = 0
+        for _, (data,labels) in enumerate(PrefetchToDeviceLoader(infer_iter, self.device)):
             with torch.no_grad():
-                data = data.to(self.device)
                 encs = self.model.encode_data(data, include_bn=include_bn)
                 if include_predictions:
                     if self.model.multilabel:
-                        preds = list(self.model.predict(data).sigmoid().detach().numpy())
+                        preds = self.model.predict(data).sigmoid().cpu().numpy()
                     else:
-                        preds = list(self.model.predict(data).softmax(dim=1).detach().numpy())
+                        preds = self.model.predict(data).softmax(dim=1).cpu().numpy()
                 if use_probs:
-                    #e1 = (encs - encs.min(dim=1).unsqueeze(1)).astype('float64')
-                    e1 = (encs - encs.min(dim=1)[0].unsqueeze(1))
-                    encs = list(torch.nn.functional.softmax(e1, dim=-1).numpy())
-                    encs = list(map(partial(recalibrate_scores, target_entropy=target_entropy), encs))
+                    ## softmax is shift-invariant, so no need to subtract the row minimum first
+                    encs = torch.nn.functional.softmax(encs, dim=-1).cpu().numpy()
+                    encs = np.array(list(map(partial(recalibrate_scores, target_entropy=target_entropy), encs)))
                 else:
-                    encs = list(encs.numpy())
-                encodings.extend(encs)
+                    encs = encs.cpu().numpy()
+                bs = encs.shape[0]
+                if encodings is None:
+                    encodings = np.empty((n_docs, encs.shape[1]), dtype=encs.dtype)
+                    if include_predictions:
+                        predictions = np.empty((n_docs, preds.shape[1]), dtype=preds.dtype)
+                encodings[pos:pos+bs] = encs
                 if include_predictions:
-                    predictions.extend(preds)
+                    predictions[pos:pos+bs] = preds
+                pos += bs
+        if encodings is None:
+            encodings = np.empty((0, self.model.n_latent), dtype=np.float32)
+            if include_predictions:
+                predictions = np.empty((0, self.model.n_labels), dtype=np.float32)
         return encodings, predictions
     
 
@@ -201,7 +279,7 @@ class BowVAEInferencer(BaseInferencer):
         return all_stats
 
     def get_top_k_words_per_topic(self, k):
-        sorted_ids = self.model.get_ordered_terms()
+        sorted_ids = self.model.get_top_k_terms(k)
         topic_terms = []
         for t in range(self.n_latent):
             top_k = [ self.vocab.lookup_token(int(i)) for i in list(sorted_ids[:k, t]) ]
@@ -217,7 +295,7 @@ class BowVAEInferencer(BaseInferencer):
         return topic_terms
 
 
-    def predict_text(self, txt: List[str], pred_threshold: float = 0.5) -> Tuple[List[str], List[np.ndarray], np.ndarray]:
+    def predict_text(self, txt: List[str], pred_threshold: float = 0.5) -> Tuple[List[str], np.ndarray, np.ndarray]:
         """Take a list of input documents/passages as strings and return document encodings (topics) and classification outputs
         
         Parameters:
@@ -291,8 +369,7 @@ class SeqVEDInferencer(BaseInferencer):
             _, input_ids, mask, bow = seqs
             encs = self.model.forward_encode(input_ids.to(self.device), mask.to(self.device))
             if use_probs:
-                e1 = (encs - encs.min(dim=1)[0].unsqueeze(1))
-                encs = list(torch.nn.functional.softmax(e1, dim=-1).cpu().detach().numpy())
+                encs = list(torch.nn.functional.softmax(encs, dim=-1).cpu().detach().numpy())
                 encs = list(map(partial(recalibrate_scores, target_entropy=target_entropy), encs))
             else:
                 encs = encs.cpu().detach().numpy()
@@ -317,7 +394,7 @@ class SeqVEDInferencer(BaseInferencer):
 
     def get_top_k_words_per_topic(self, k):
         if self.vocab:
-            sorted_ids = self.model.get_ordered_terms()
+            sorted_ids = self.model.get_top_k_terms(k)
             topic_terms = []
             for t in range(self.model.n_latent):
                 top_k = self.vocab.lookup_tokens(sorted_ids[:k, t]) 
@@ -48,30 +48,41 @@ class BaseVAE(nn.Module):
     def freeze_pre_encoder(self):
         pass
 
+    def _get_decoder_jacobian(self):
+        ## the decoder is linear, so its jacobian w.r.t. the topic vector is its (vocab_size x n_latent) weight
+        return self.decoder.weight.detach()
+
     def get_ordered_terms(self):
         """
         Returns the top K terms for each topic based on sensitivity analysis. Terms whose 
         probability increases the most for a unit increase in a given topic score/probability
         are those most associated with the topic.
         """
-        z = torch.ones((self.n_latent,), device=self.device)
-        jacobian = torch.autograd.functional.jacobian(self.decoder, z)
+        jacobian = self._get_decoder_jacobian()
         sorted_j = jacobian.argsort(dim=0, descending=True)
         return sorted_j.cpu().numpy()
+
+    def get_top_k_terms(self, k):
+        """
+        Returns the top k terms for each topic as a (k x n_latent) array of term ids. Terms are
+        ranked as in `get_ordered_terms` but only the top k are selected, avoiding a full sort
+        over the vocabulary.
+        """
+        jacobian = self._get_decoder_jacobian()
+        _, top_k = torch.topk(jacobian, min(k, jacobian.shape[0]), dim=0)
+        return top_k.cpu().numpy()
     
     def get_topic_vectors(self):
         """
         Returns unnormalized topic vectors
         """
-        z = torch.ones((self.n_latent,), device=self.device)
-        jacobian = torch.autograd.functional.jacobian(self.decoder, z)
-        return jacobian.cpu().numpy()        
+        jacobian = self._get_decoder_jacobian()
+        return jacobian.cpu().numpy().copy()
 
 
     def add_npmi_and_diversity_loss(self, cur_loss):
         if self.npmi_with_diversity_loss:
-            z = torch.ones((self.n_latent,), device=self.device)
-            jacobian = torch.autograd.functional.jacobian(self.decoder, z) 
+            jacobian = self._get_decoder_jacobian()
             npmi_loss = self.npmi_with_diversity_loss(jacobian)
             npmi_loss = npmi_loss.sum()
             return (cur_loss + npmi_loss)
@@ -79,9 +90,19 @@ class BaseVAE(nn.Module):
             return cur_loss
 
 
-    def get_loss_terms(self, data, y, KL):
-        rr = data * torch.log(y+1e-12)
-        recon_loss = -(rr.sum(dim=1))
+    def _get_reconstruction_loss(self, data, log_y):
+        if data.is_sparse:
+            ## only gather the log-probabilities at the non-zero term counts
+            data = data.coalesce()
+            rows, cols = data.indices()
+            rr = torch.zeros(data.shape[0], dtype=log_y.dtype, device=log_y.device)
+            rr = rr.index_add(0, rows, data.values() * log_y[rows, cols])
+            return -rr
+        else:
+            return -((data * log_y).sum(dim=1))
+
+    def get_loss_terms(self, data, log_y, KL):
+        recon_loss = self._get_reconstruction_loss(data, log_y)
         i_loss = KL + recon_loss
         ii_loss = self.add_npmi_and_diversity_loss(i_loss)
         return ii_loss, recon_loss
@@ -124,8 +145,20 @@ class BowVAEModel(BaseVAE):
             self.lab_dr = torch.nn.Dropout(self.classifier_dropout)
             self.classifier = torch.nn.Linear(self.n_latent, self.n_labels, bias=True)
             
+        self._compiled_dense_forward = None
         self.apply(self._init_weights)
 
+    def __getstate__(self):
+        ## compiled callables can't be pickled (e.g. by `torch.save`); the model is saved uncompiled
+        state = self.__dict__.copy()
+        state['_compiled_dense_forward'] = None
+        return state
+
+    def __setstate__(self, state):
+        ## models pickled before `compile_dense_forward` was added lack this attribute
+        state.setdefault('_compiled_dense_forward', None)
+        super(BowVAEModel, self).__setstate__(state)
+
     def _init_weights(self, module):
         if isinstance(module, torch.nn.Linear):
             torch.nn.init.kaiming_uniform_(module.weight.data)
@@ -152,7 +185,7 @@ class BowVAEModel(BaseVAE):
         
         for bi, (data, _) in enumerate(dataloader):
             if sample_size > 0 and samples >= sample_size:
-                print("Sample processed, exiting..")
+                logging.debug("Sample processed, exiting..")
                 break
             samples += data.shape[0]
             x_data = x_data.to(device = self.device)
@@ -174,7 +207,7 @@ class BowVAEModel(BaseVAE):
         
         for bi, (data, _) in enumerate(dataloader):
             if sample_size > 0 and samples >= sample_size:
-                print("Sample processed, exiting..")
+                logging.debug("Sample processed, exiting..")
                 break
             samples += data.shape[0]
             x_data = x_data.to(device = self.device)
@@ -218,22 +251,40 @@ class BowVAEModel(BaseVAE):
         return self.classifier(self.lab_dr(self.encode_data(data)))
     
 
-    def forward(self, data):
-        data = data.to_dense()
-        batch_size = data.shape[0]
-        emb_out = self.embedding(data)
+    def compile_dense_forward(self, **compile_kwargs):
+        """Compile the dense part of `forward` with `torch.compile`.
+
+        Sparse batches can't be traced by `torch.compile`. The embedding product and the
+        reconstruction loss therefore stay eager, and only the layers in between are compiled.
+        The compiled layers are used in training mode only, so evaluation doesn't trigger a recompile.
+
+        Parameters:
+            compile_kwargs: Keyword arguments passed on to `torch.compile`
+        """
+        self._compiled_dense_forward = torch.compile(self._dense_forward, **compile_kwargs)
+
+    def _dense_forward(self, emb_out):
+        batch_size = emb_out.shape[0]
         #z, KL = self.run_encode(F, emb_out, batch_size)
         enc_out = self.encoder(emb_out)
         z, KL   = self.latent_distribution(enc_out, batch_size)
         xhat = self.decoder(z)
-        y = torch.nn.functional.softmax(xhat, dim=1)
-        ii_loss, recon_loss = \
-            self.get_loss_terms(data, y, KL)
+        log_y = torch.nn.functional.log_softmax(xhat, dim=1)
         if self.has_classifier:
             mu_out  = self.latent_distribution.get_mu_encoding(enc_out)
             classifier_outputs = self.classifier(self.lab_dr(mu_out))
         else:
             classifier_outputs = None
+        return log_y, KL, classifier_outputs
+
+    def forward(self, data):
+        ## sparse batches are kept sparse: the embedding layer and reconstruction loss
+        ## only touch the non-zero entries
+        emb_out = self.embedding(data)
+        dense_forward = self._compiled_dense_forward if self.training and self._compiled_dense_forward else self._dense_forward
+        log_y, KL, classifier_outputs = dense_forward(emb_out)
+        ii_loss, recon_loss = \
+            self.get_loss_terms(data, log_y, KL)
         return ii_loss, KL, recon_loss, classifier_outputs
 
 
@@ -248,8 +299,8 @@ class MetricBowVAEModel(BowVAEModel):
         batch_size = bow.shape[0]
         z, KL = self.latent_distribution(enc, batch_size)
         KL_loss = (KL * self.kld_wt)
-        y = torch.nn.functional.softmax(self.decoder(z), dim=1)
-        rec_loss = -torch.sum( bow * torch.log(y+1e-12), dim=1 )
+        log_y = torch.nn.functional.log_softmax(self.decoder(z), dim=1)
+        rec_loss = self._get_reconstruction_loss(bow, log_y)
         elbo = rec_loss + KL_loss
         return elbo, rec_loss, KL_loss
 
@@ -285,25 +336,21 @@ class NPMILossWithDiversity(nn.Module):
         self.k = k
         
     def _row_wise_normalize_inplace(self, x, mask=None):
-        for row_idx, row in enumerate(x):
-            if mask != None:
-                row_mask = mask[row_idx]
-                row = row[row_mask]
-                x[row_idx][row_mask] = (row - row.min()) / (row.max() - row.min())
-            else:
-                row_min = row.min().item()
-                row_max = row.max().item()
-                x[row_idx] = (row - row_min)/(row_max - row_min)
+        if mask is not None:
+            row_min = x.masked_fill(~mask, float('inf')).min(dim=1, keepdim=True)[0]
+            row_max = x.masked_fill(~mask, float('-inf')).max(dim=1, keepdim=True)[0]
+            x.copy_(torch.where(mask, (x - row_min) / (row_max - row_min), x))
+        else:
+            row_min = x.min(dim=1, keepdim=True)[0]
+            row_max = x.max(dim=1, keepdim=True)[0]
+            x.sub_(row_min).div_(row_max - row_min)
         return x
 
     def _get_npmi_loss(self, jacobian):
         beta = jacobian.t()
-        n_topics = beta.shape[0]
         self.npmi_matrix.fill_diagonal_(1)
         topk_idx = torch.topk(beta, self.k, dim=1)[1]
-        topk_mask = torch.zeros_like(beta)
-        for row_idx, indices in enumerate(topk_idx):
-            topk_mask[row_idx, indices] = 1
+        topk_mask = torch.zeros_like(beta).scatter_(1, topk_idx, 1.0)
         beta_mask = (1 - topk_mask) * -99999
         topk_mask = topk_mask.bool()
         topk_softmax_beta = torch.softmax(beta + beta_mask, dim=1)
@@ -312,11 +359,9 @@ class NPMILossWithDiversity(nn.Module):
         #print("Weighted_npmi sum = {}".format(weighted_npmi.sum()))
         npmi_loss = self.npmi_scale * (softmax_beta ** 2) * weighted_npmi
         if self.use_diversity_loss:
-            diversity_mask = torch.zeros_like(beta).bool()
-            for topic_idx in range(n_topics):
-                other_rows_mask = torch.ones(n_topics).bool().to(self.device)
-                other_rows_mask[topic_idx] = False
-                diversity_mask[topic_idx] = topk_mask[other_rows_mask].sum(0) > 0
+            ## a term is masked for a topic if it is in the top-k of any *other* topic
+            topk_counts = topk_mask.int()
+            diversity_mask = (topk_counts.sum(0, keepdim=True) - topk_counts) > 0
             npmi_loss = ( self.npmi_lambda * torch.masked_select(npmi_loss, diversity_mask)).sum() + \
                         ((1 - self.npmi_lambda) * torch.masked_select(npmi_loss, ~diversity_mask)).sum()
             npmi_loss *= 2
@@ -416,8 +461,7 @@ class BaseSeqBowVED(BaseVAE):
         probability increases the most for a unit increase in a given topic score/probability
         are those most associated with the topic.
         """
-        z = torch.ones((self.n_latent,), device=self.device)
-        jacobian = torch.autograd.functional.jacobian(self.decoder, z)
+        jacobian = self._get_decoder_jacobian()
         sorted_j = jacobian.argsort(dim=0, descending=True)
         return sorted_j.cpu().numpy()
             
@@ -436,8 +480,8 @@ class BaseSeqBowVED(BaseVAE):
         z, KL = self.latent_distribution(enc, bow.size()[0])
         KL_loss = (KL * self.kld_wt)
         dec = self.decoder(z)
-        y = torch.nn.functional.softmax(dec, dim=1)
-        rec_loss = -torch.sum( bow.to_dense() * torch.log(y+1e-12), dim=1 )
+        log_y = torch.nn.functional.log_softmax(dec, dim=1)
+        rec_loss = self._get_reconstruction_loss(bow, log_y)
         entropy_loss = self._get_latent_sparsity_term(z)
         elbo = rec_loss + KL_loss + (entropy_loss * self.entropy_loss_coef)
         return elbo, rec_loss, KL_loss, entropy_loss
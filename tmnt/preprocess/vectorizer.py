@@ -6,6 +6,8 @@ Copyright (c) 2019-2021 The MITRE Corporation.
 import io
 import os
 import json
+import codecs
+import logging
 from tmnt.utils.vocab import Vocab, build_vocab
 import glob
 from multiprocessing import Pool, cpu_count
@@ -26,9 +28,28 @@ from sklearn.feature_extraction.text import TfidfTransformer
 from sklearn.utils.validation import FLOAT_DTYPES, check_is_fitted
 from sklearn.feature_extraction._stop_words import ENGLISH_STOP_WORDS
 
+try:
+    import pyarrow as pa
+    import pyarrow.json as pa_json
+except ImportError:
+    pa, pa_json = None, None
+
 
 __all__ = ['TMNTVectorizer', 'CTFIDFVectorizer']
 
+## bytes of a json list file parsed at a time by pyarrow, bounding the memory used to read it
+_JSON_BLOCK_SIZE = 1 << 24
+
+## fitted CountVectorizer installed in each worker process by `_init_transform_worker`
+_worker_vectorizer = None
+
+def _init_transform_worker(vectorizer):
+    global _worker_vectorizer
+    _worker_vectorizer = vectorizer
+
+def _transform_chunk(docs):
+    return _worker_vectorizer.transform(docs)
+
 class TMNTVectorizer(object):
 
     """
@@ -53,6 +74,9 @@ class TMNTVectorizer(object):
         max_ws_tokens: Maximum number of (whitespace deliniated) tokens to use
         count_vectorizer_kwargs: Dictionary of parameter values to pass to 
                 :py:class:`sklearn.feature_extraction.text.CountVectorizer`
+        n_jobs: Number of worker processes used to transform documents with a fitted vocabulary;
+                -1 uses all cores (default = 1)
+        docs_per_job: Number of documents handed to a worker process at a time (default = 512)
     """
     def __init__(self, text_key: str = 'body', label_key: Optional[str] = None, min_doc_size: int = 1,
                  label_remap: Optional[Dict[str,str]] = None,
@@ -63,8 +87,12 @@ class TMNTVectorizer(object):
                  max_ws_tokens: int = -1,
                  source_key: Optional[str] = None,
                  source_json: Optional[str] = None,
-                 count_vectorizer_kwargs: Dict[str, Any] = {'max_df':0.95, 'min_df':0.0, 'stop_words':'english'}):
+                 count_vectorizer_kwargs: Dict[str, Any] = {'max_df':0.95, 'min_df':0.0, 'stop_words':'english'},
+                 n_jobs: int = 1,
+                 docs_per_job: int = 512):
         self.encoding = encoding
+        self.n_jobs = cpu_count() if n_jobs < 0 else n_jobs
+        self.docs_per_job = docs_per_job
         self.max_ws_tokens = max_ws_tokens
         self.text_key = text_key
         self.label_key = label_key
@@ -94,6 +122,12 @@ class TMNTVectorizer(object):
         self.label_map = {}
 
 
+    def __setstate__(self, state):
+        ## vectorizers pickled before parallel transform was added lack these attributes
+        state.setdefault('n_jobs', 1)
+        state.setdefault('docs_per_job', 512)
+        self.__dict__.update(state)
+
     def _get_source_specific_terms(self, json_file, k: int, text_key: str, source_key: str, cv_kwargs):
         by_source = {}
         with io.open(json_file) as fp:
@@ -105,7 +139,7 @@ class TMNTVectorizer(object):
                     by_source[src] = []
                 by_source[src].append(txt)
         docs_by_source = [''.join(txts) for txts in by_source.values()]
-        print(cv_kwargs)
+        logging.debug("Source-specific term CountVectorizer arguments: {}".format(cv_kwargs))
         count_vectorizer = CountVectorizer(**cv_kwargs)
         count = count_vectorizer.fit_transform(docs_by_source)
         ctfidf = CTFIDFVectorizer().fit_transform(count)
@@ -123,7 +157,7 @@ class TMNTVectorizer(object):
             final_tokens_intersect.intersection_update(src_tokens)
             final_tokens_union.update(src_tokens)
         res = final_tokens_union - final_tokens_intersect
-        print("Removed terms = {}".format(res))
+        logging.info("Removed terms = {}".format(res))
         return final_tokens_union - final_tokens_intersect
 
 
@@ -229,37 +263,70 @@ class TMNTVectorizer(object):
             return s
 
     
+    def _transform(self, docs):
+        if self.n_jobs <= 1:
+            return self.vectorizer.transform(docs)
+        docs = list(docs)
+        if len(docs) < 2 * self.docs_per_job:
+            return self.vectorizer.transform(docs)
+        chunks = [ docs[i:i+self.docs_per_job] for i in range(0, len(docs), self.docs_per_job) ]
+        with Pool(self.n_jobs, initializer=_init_transform_worker, initargs=(self.vectorizer,)) as pool:
+            mats = pool.map(_transform_chunk, chunks)
+        return sp.vstack(mats, format='csr')
+
+    def _iter_json_str_column(self, json_file, key):
+        """Yield the values of `key` from a json list file.
+
+        Values are streamed block by block with pyarrow's native reader. If pyarrow is unavailable
+        or the file is not UTF-8, the file is parsed line by line instead. If a value is missing or
+        is not a string, line-by-line parsing takes over from the first value not yet yielded.
+        """
+        n_read = 0
+        if pa_json is not None and codecs.lookup(self.encoding).name == 'utf-8':
+            parse_options = pa_json.ParseOptions(explicit_schema=pa.schema([(key, pa.string())]),
+                                                 unexpected_field_behavior='ignore')
+            read_options = pa_json.ReadOptions(block_size=_JSON_BLOCK_SIZE)
+            try:
+                for batch in pa_json.open_json(json_file, read_options=read_options, parse_options=parse_options):
+                    column = batch.column(key)
+                    if column.null_count > 0:
+                        break
+                    values = column.to_pylist()
+                    yield from values
+                    n_read += len(values)
+                else:
+                    return
+            except (pa.ArrowInvalid, KeyError):
+                pass
+        with io.open(json_file, 'r', encoding=self.encoding) as fp:
+            for i, l in enumerate(fp):
+                if i >= n_read:
+                    yield json.loads(l)[key]
+
     def _tr_json(self, tr_method, json_file):
-        fp = io.open(json_file, 'r', encoding=self.encoding)
-        gen = ( self._truncate_to_ws_tokens(json.loads(l)[self.text_key]) for l in fp )
+        gen = ( self._truncate_to_ws_tokens(t) for t in self._iter_json_str_column(json_file, self.text_key) )
         rr = tr_method(gen)
         if self.additional_feature_keys:
             X_add = self._add_features_json(json_file, rr.shape[0])
             rr = sp.csr_matrix(sp.hstack((rr, sp.csr_matrix(X_add))))
-        fp.close()
         return rr
 
     def _tr_json_dir(self, tr_method, json_dir):
-        fps = [ io.open(ff, 'r', encoding=self.encoding) for ff in glob.glob(json_dir + '/' + self.file_pat) ]
-        gen = ( self._truncate_to_ws_tokens(json.loads(l)[self.text_key]) for fp in fps for l in fp)
+        files = glob.glob(json_dir + '/' + self.file_pat)
+        gen = ( self._truncate_to_ws_tokens(t) for ff in files for t in self._iter_json_str_column(ff, self.text_key) )
         rr = tr_method(gen)
         if self.additional_feature_keys:
             X_add = self._add_features_json_dir(json_dir, rr.shape[0])
             rr = sp.csr_matrix(sp.hstack((rr, sp.csr_matrix(X_add))))
-        for fp in fps:
-            fp.close()
         return rr
 
     def _get_y_strs(self, json_file):
         ys = [] # ys will be a list of lists of strings to accomodate multilabel data
-        with io.open(json_file, 'r', encoding=self.encoding) as fp:
-            for j in fp:
-                js = json.loads(j)
-                label_string = js.get(self.label_key)
-                label_string_list = label_string.split(self.split_char)
-                if self.label_remap:
-                    label_string_list = [ self.label_remap.get(label_string) or label_string for label_string in label_string_list ]
-                ys.append(label_string_list) 
+        for label_string in self._iter_json_str_column(json_file, self.label_key):
+            label_string_list = label_string.split(self.split_char)
+            if self.label_remap:
+                label_string_list = [ self.label_remap.get(label_string) or label_string for label_string in label_string_list ]
+            ys.append(label_string_list) 
         return ys
 
     def _get_y_strs_dir(self, json_dir):
@@ -349,7 +416,7 @@ class TMNTVectorizer(object):
         Returns:
             Tuple of X,None - sparse matrix of the input, second element is always None in this case
         """
-        return self.vectorizer.transform(str_list), None
+        return self._transform(str_list), None
 
     def transform_json(self, json_file: str) -> Tuple[sp.csr.csr_matrix, Optional[np.ndarray]]:
         """Transforms a single json list file into matrix/vector format(s).         
@@ -362,7 +429,7 @@ class TMNTVectorizer(object):
         Returns:
             Tuple containing sparse document-term matrix X and optional label vector y
         """
-        X = self._tr_json(self.vectorizer.transform, json_file)
+        X = self._tr_json(self._transform, json_file)
         y = self._get_ys(json_file)
         return X, y
 
@@ -374,7 +441,7 @@ class TMNTVectorizer(object):
         Returns:
             Tuple containing sparse document-term matrix X and optional label vector y
         """
-        X = self._tr_json_dir(self.vectorizer.transform, json_dir)
+        X = self._tr_json_dir(self._transform, json_dir)
         y = self._get_ys_dir(json_dir)
         return X, y
 